@@ -1,13 +1,19 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import datetime
+import time
 import io
 import smtplib
+import threading
+from contextlib import contextmanager
 from email.mime.text import MIMEText
 from email.utils import formatdate, formataddr
 from email.header import Header
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+
+# スライスや列の取り出しは書き込まれるまでコピーしない (pandas 3以降は標準動作で、設定すると警告が出る)
+if int(pd.__version__.split(".")[0]) < 3:
+    pd.options.mode.copy_on_write = True
 
 # --- 定数設定 ---
 PRIORITY_OPTIONS = ["高", "中", "低"]
@@ -24,122 +30,202 @@ SPREADSHEET_ORDER = [
     "担当者1", "担当者2", "担当者3", 
     "優先度", "進捗", "期限", "完了日", "備考"
 ]
+TEXT_COLS = ["タイトル", "詳細", "依頼者", "担当者1", "担当者2", "担当者3", "備考"]
+ASSIGNEE_COLS = ["担当者1", "担当者2", "担当者3"]
+
+# tasks_dfの列 (削除チェックは表示用にだけ付ける)
+TASK_COLS = ("通知", *SPREADSHEET_ORDER)
+
+# 一覧表示の列順序・列設定
+ACTIVE_COLS = ("通知", "削除", *SPREADSHEET_ORDER)
+COMPLETED_COLS = tuple(SPREADSHEET_ORDER)
+COL_CFG = {
+    "通知": st.column_config.CheckboxColumn(width="small", label="✉️", help="チェックしたタスクをメール通知します"),
+    "削除": st.column_config.CheckboxColumn(width="small", label="🗑️"),
+    "期限": st.column_config.DateColumn(format="YYYY-MM-DD"),
+    "完了日": st.column_config.DateColumn(format="YYYY-MM-DD"),
+    # カテゴリ型の列は空にするとNaNになり、シートへ送れなくなるので空欄にさせない
+    "優先度": st.column_config.SelectboxColumn(options=PRIORITY_OPTIONS, required=True),
+    "進捗": st.column_config.SelectboxColumn(options=STATUS_OPTIONS, required=True)
+}
 
 # --- Google Sheets 認証 ---
+# アクセストークンの有効期限(1時間)より前に作り直す
+@st.cache_resource(ttl=3000, show_spinner=False)
 def get_gspread_client():
+    # gspread関連はシートへ接続するときだけ読み込む
+    import gspread
+    from oauth2client.service_account import ServiceAccountCredentials
     scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
     creds_dict = st.secrets["gcp_service_account"]
     creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
     client = gspread.authorize(creds)
     return client
 
-# --- データロード・保存 ---
-def load_data():
+@st.cache_resource(ttl=3000, show_spinner=False)
+def get_sheet():
+    sheet = get_gspread_client().open(SHEET_NAME).sheet1
+    # 入力規則は変わらないので、保存のたびではなくシートを開いたときだけ設定する
+    set_validation(sheet)
+    return sheet
+
+@st.cache_resource(ttl=3000, show_spinner=False)
+def get_log_sheet():
+    # 同じスプレッドシート内の履歴用シート (見つからない場合の例外はキャッシュされない)
+    return get_sheet().spreadsheet.worksheet(LOG_SHEET_NAME)
+
+def with_sheet(func):
+    from gspread.exceptions import APIError
+    # APIError時はキャッシュ済みのシートを破棄して1回だけ再試行
     try:
-        client = get_gspread_client()
-        sheet = client.open(SHEET_NAME).sheet1
-        data = sheet.get_all_records()
-        df = pd.DataFrame(data)
+        return func(get_sheet())
+    except APIError:
+        get_sheet.clear()
+        return func(get_sheet())
+
+# --- データロード・保存 ---
+@st.cache_data(ttl=60, show_spinner=False)
+def fetch_data():
+    # 読み込み失敗はキャッシュしないよう、例外は呼び出し側で処理する
+    # get_all_recordsの行ごとのdict生成を避け、リストのリストから直接DataFrameを作る
+    values = with_sheet(lambda sheet: sheet.get_all_values())
+    if not values:
+        df = pd.DataFrame(columns=SPREADSHEET_ORDER)
+    else:
+        df = pd.DataFrame(values[1:], columns=values[0])
+
+    # 必須カラム確保
+    for c in SPREADSHEET_ORDER:
+        if c not in df.columns: df[c] = ""
+
+    # 不要な列削除
+    if "削除" in df.columns: df = df.drop(columns=["削除"])
+    if "通知" in df.columns: df = df.drop(columns=["通知"])
         
-        if df.empty:
-            df = pd.DataFrame(columns=SPREADSHEET_ORDER)
+    # アプリ操作用列の追加
+    df.insert(0, "通知", False)
 
-        # 必須カラム確保
-        for c in SPREADSHEET_ORDER:
-            if c not in df.columns: df[c] = ""
+    df['期限'] = to_date_series(df['期限'])
+    df['完了日'] = to_date_series(df['完了日'])
 
-        # 不要な列削除
-        if "削除" in df.columns: df = df.drop(columns=["削除"])
-        if "通知" in df.columns: df = df.drop(columns=["通知"])
-            
-        # アプリ操作用列の追加
-        df.insert(0, "通知", False)
-        df.insert(1, "削除", False)
+    # Arrow文字列型で保持し、検索・絞り込みをArrowのカーネルで処理する
+    # (get_all_valuesの値はすべて文字列なので、fillna・astype(str)は不要)
+    df[TEXT_COLS] = df[TEXT_COLS].astype("string[pyarrow]")
 
-        def parse_date(x):
-            if not x or str(x).strip() == "": return None
-            try: return pd.to_datetime(x).date()
-            except: return None
+    # 優先度・進捗はカテゴリ型にして比較を整数コードで行う (想定外の値も消えないようカテゴリに含める)
+    for c, options in (("優先度", PRIORITY_OPTIONS), ("進捗", STATUS_OPTIONS)):
+        extra = [v for v in pd.unique(df[c]) if v not in options]
+        df[c] = pd.Categorical(df[c], categories=options + extra)
 
-        df['期限'] = df['期限'].apply(parse_date)
-        df['完了日'] = df['完了日'].apply(parse_date)
+    return df
 
-        text_cols = ["タイトル", "詳細", "依頼者", "担当者1", "担当者2", "担当者3", "備考"]
-        for c in text_cols: df[c] = df[c].fillna("").astype(str)
+# tasks_dfを書き換えたら呼ぶ (セッション内の派生データのキャッシュキー)
+def bump_data_version():
+    st.session_state.data_version = st.session_state.get("data_version", 0) + 1
 
+def load_data():
+    bump_data_version()
+    try:
+        df = fetch_data()
+        st.session_state.sheet_rows = len(df)
+        st.session_state.saved_values = to_sheet_values(df)
+        st.session_state.delete_marks = set()
         return df
     except Exception as e:
         st.error(f"データ読み込みエラー: {e}")
-        cols_with_app = ["通知", "削除"] + SPREADSHEET_ORDER
-        return pd.DataFrame(columns=cols_with_app)
+        return pd.DataFrame(columns=list(TASK_COLS))
+
+def to_sheet_values(df):
+    # シートの列だけを取り出し(通知は落ちる)、全体のコピーは作らずに日付列だけ書き換える
+    save_df = df.reindex(columns=SPREADSHEET_ORDER)
+
+    for c in ['期限', '完了日']:
+        save_df[c] = pd.to_datetime(save_df[c], errors='coerce').dt.strftime('%Y-%m-%d').fillna("")
+    
+    return save_df.values.tolist()
 
 def save_data(df):
     try:
-        client = get_gspread_client()
-        sheet = client.open(SHEET_NAME).sheet1
-        
-        save_df = df.copy()
-        
-        if "通知" in save_df.columns: save_df = save_df.drop(columns=["通知"])
-        if "削除" in save_df.columns: save_df = save_df.drop(columns=["削除"])
-
-        for c in ['期限', '完了日']:
-            save_df[c] = save_df[c].apply(lambda x: x.strftime('%Y-%m-%d') if x is not None and pd.notnull(x) else "")
-        
-        save_df = save_df.reindex(columns=SPREADSHEET_ORDER)
-        
-        sheet.batch_clear(["A2:K1000"])
-        data = save_df.values.tolist()
-        if len(data) > 0:
-            sheet.update(range_name='A2', values=data)
-            
-        set_validation(sheet)
-        st.cache_data.clear()
+        data = to_sheet_values(df)
+        prev = st.session_state.get("saved_values")
+        # 前回保存時と内容が同じなら書き込まない (編集を元に戻した場合も未保存扱いを解除する)
+        if data == prev:
+            st.session_state.dirty = False
+            return True
+
+        # 前回書き込んだ行数までは空行で上書きし、クリアと書き込みを1回のAPI呼び出しにまとめる
+        # (行数が不明な場合は従来どおりA2:K1000全体を対象にする)
+        # 1000行程度のシートでは通信回数が効くので、差分だけを書く方式より1回の全体書き込みの方が速い
+        end_row = max(st.session_state.get("sheet_rows", 999), len(data))
+        padded = data + [[""] * len(SPREADSHEET_ORDER)] * (end_row - len(data))
+        if end_row > 0:
+            with_sheet(lambda sheet: sheet.update(range_name=f'A2:K{end_row + 1}', values=padded))
+        st.session_state.sheet_rows = len(data)
+        st.session_state.saved_values = data
+        st.session_state.dirty = False
+        fetch_data.clear()
         return True
     except Exception as e:
         st.error(f"保存エラー: {e}")
         return False
 
+# 一覧での編集は手元に反映するだけにし、保存はまとめて行う
+def apply_edited_rows(edited_rows, view_df):
+    # 列ごとに行と値をまとめ、1列につき1回の代入で反映する
+    by_col = {}
+    for idx, chg in edited_rows.items():
+        real_idx = view_df.index[idx]
+        for c, v in chg.items():
+            rows, vals = by_col.setdefault(c, ([], []))
+            rows.append(real_idx)
+            # 空にしたテキストセルはNoneではなく空文字で保持する
+            vals.append("" if v is None and c in TEXT_COLS else v)
+
+    # 削除チェックはtasks_dfではなく行番号の集合で持つ
+    rows, vals = by_col.pop("削除", ([], []))
+    for r, v in zip(rows, vals):
+        if v: st.session_state.delete_marks.add(r)
+        else: st.session_state.delete_marks.discard(r)
+
+    for c, (rows, vals) in by_col.items():
+        st.session_state.tasks_df.loc[rows, c] = vals
+    bump_data_version()
+
+    # 通知・削除のチェックだけならシートへの書き込みは不要
+    if any(c in SPREADSHEET_ORDER for c in by_col):
+        st.session_state.dirty = True
+        st.session_state.last_edit = time.monotonic()
+    # 日付の再変換は日付列が編集されたときだけ
+    for c in ['期限', '完了日']:
+        if c in by_col: st.session_state.tasks_df[c] = to_date_series(st.session_state.tasks_df[c])
+
 # ★削除ログ保存用の新機能
 def save_deleted_log(deleted_df):
     try:
-        client = get_gspread_client()
         # 履歴用シートを開く（名前注意：deleted_tasks）
         try:
-            log_sheet = client.open(SHEET_NAME).worksheet(LOG_SHEET_NAME)
+            log_sheet = get_log_sheet()
         except:
             st.error(f"エラー: スプレッドシートに '{LOG_SHEET_NAME}' という名前のシートが見つかりません。作成してください。")
             return False
 
-        save_df = deleted_df.copy()
-        
-        # 不要な列を削除
-        if "通知" in save_df.columns: save_df = save_df.drop(columns=["通知"])
-        if "削除" in save_df.columns: save_df = save_df.drop(columns=["削除"])
-        
-        # 日付整形
-        for c in ['期限', '完了日']:
-            save_df[c] = save_df[c].apply(lambda x: x.strftime('%Y-%m-%d') if x is not None and pd.notnull(x) else "")
-            
-        save_df = save_df.reindex(columns=SPREADSHEET_ORDER)
-        
         # 削除日を追加（先頭に）
-        save_df.insert(0, "削除日時", datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
-        
-        data = save_df.values.tolist()
+        deleted_at = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        data = [[deleted_at] + row for row in to_sheet_values(deleted_df)]
         if len(data) > 0:
             log_sheet.append_rows(data)
+            load_deleted_log.clear()
         return True
     except Exception as e:
         st.error(f"履歴保存エラー: {e}")
         return False
 
 # ★削除履歴の読み込み機能
+@st.cache_data(ttl=60, show_spinner=False)
 def load_deleted_log():
     try:
-        client = get_gspread_client()
         try:
-            log_sheet = client.open(SHEET_NAME).worksheet(LOG_SHEET_NAME)
+            log_sheet = get_log_sheet()
         except:
             return pd.DataFrame()
             
@@ -163,61 +249,126 @@ def set_validation(sheet):
             }
         }
     ]
-    try: sheet.batch_update({"requests": requests})
+    try: sheet.spreadsheet.batch_update({"requests": requests})
     except: pass
 
-def send_gmail(subject, body, to_email, to_name, from_email, from_name, app_password):
+# ログイン済みのSMTP接続をプロセス内で使い回す
+@st.cache_resource(show_spinner=False)
+def get_smtp(from_email, app_password):
+    smtp = smtplib.SMTP('smtp.gmail.com', 587)
     try:
-        msg = MIMEText(body, 'plain', 'utf-8')
-        msg['Subject'] = Header(subject, 'utf-8')
-        msg['From'] = formataddr((Header(from_name, 'utf-8').encode(), from_email))
-        msg['To'] = formataddr((Header(to_name, 'utf-8').encode(), to_email))
-        msg['Date'] = formatdate()
-        
-        smtp = smtplib.SMTP('smtp.gmail.com', 587)
         smtp.ehlo()
         smtp.starttls()
         smtp.ehlo()
         smtp.login(from_email, app_password)
-        smtp.sendmail(from_email, to_email, msg.as_string())
+    except Exception:
         smtp.close()
+        raise
+    return smtp
+
+@st.cache_resource(show_spinner=False)
+def get_smtp_lock():
+    return threading.Lock()
+
+# 共有接続は同時に1セッションだけが使う。切断されていれば張り直す
+@contextmanager
+def smtp_session(from_email, app_password):
+    with get_smtp_lock():
+        smtp = get_smtp(from_email, app_password)
+        try: smtp.noop()
+        except (smtplib.SMTPException, OSError):
+            get_smtp.clear()
+            smtp = get_smtp(from_email, app_password)
+        yield smtp
+
+# to_emailはアドレス1件またはリスト。複数宛先は1回の送信(RCPT TO複数)でまとめて送る
+def send_gmail(subject, body, to_email, to_name, from_email, from_name, app_password, smtp=None):
+    try:
+        to_emails = [to_email] if isinstance(to_email, str) else list(to_email)
+        msg = MIMEText(body, 'plain', 'utf-8')
+        msg['Subject'] = Header(subject, 'utf-8')
+        msg['From'] = formataddr((Header(from_name, 'utf-8').encode(), from_email))
+        if len(to_emails) == 1:
+            msg['To'] = formataddr((Header(to_name, 'utf-8').encode(), to_emails[0]))
+        else:
+            msg['To'] = ", ".join(to_emails)
+        msg['Date'] = formatdate()
+        
+        if smtp is None:
+            with smtp_session(from_email, app_password) as smtp:
+                smtp.sendmail(from_email, to_emails, msg.as_string())
+        else:
+            smtp.sendmail(from_email, to_emails, msg.as_string())
         return True
     except Exception as e:
         st.error(f"送信エラー: {e}")
         return False
 
-def ensure_date_columns(df):
-    for c in ['期限', '完了日']:
-        if c in df.columns:
-            df[c] = pd.to_datetime(df[c], errors='coerce').apply(lambda x: x.date() if pd.notnull(x) else None)
-    return df
+def to_date_series(s):
+    # 一括変換後、NaTはNoneに揃える
+    # (手入力で「2024/1/7」などの書式が混在するため、先頭の値から書式を決め打ちさせない)
+    ts = pd.to_datetime(s, errors='coerce', format='mixed')
+    return ts.dt.date.astype(object).where(ts.notna(), None)
+
+# tasks_dfが書き換えられるまではセッション内の計算結果を再利用
+def get_assignees(ass_cols):
+    cached = st.session_state.get("assignees_cache")
+    version = st.session_state.get("data_version", 0)
+    if cached and cached[0] == version: return cached[1]
+
+    ass_df = st.session_state.tasks_df
+    # 欠損は空文字にして1次元配列のまま連結する (2次元の.valuesは作らない)
+    unique_ass = pd.unique(np.concatenate([ass_df[c].to_numpy(dtype=object, na_value="") for c in ass_cols]))
+    assignees = sorted(x for x in unique_ass if x and str(x).lower() not in ("nan", "none"))
+    st.session_state.assignees_cache = (version, assignees)
+    return assignees
+
+# 期限切れ・優先度「高」の未完了タスクをNumPyのマスクで数える
+# (tasks_dfが書き換えられるか日付が変わるまではセッション内の結果を再利用)
+def count_alerts(today):
+    key = (st.session_state.get("data_version", 0), today)
+    cached = st.session_state.get("alerts_cache")
+    if cached and cached[0] == key: return cached[1]
+
+    alert_df = st.session_state.tasks_df
+    due = pd.to_datetime(alert_df['期限'], errors='coerce').to_numpy()
+    is_expired = due < np.datetime64(today)
+    mask = (alert_df['進捗'].to_numpy() != '完了') & (is_expired | (alert_df['優先度'].to_numpy() == '高'))
+    count = int(mask.sum())
+    st.session_state.alerts_cache = (key, count)
+    return count
 
 # --- UI構築 ---
 st.set_page_config(layout="wide", page_title="社内タスク管理システム", page_icon="📝")
 
 if 'tasks_df' not in st.session_state:
-    st.session_state.tasks_df = ensure_date_columns(load_data())
+    st.session_state.tasks_df = load_data()
 
-cols_check = set(["通知", "削除"] + SPREADSHEET_ORDER)
+cols_check = set(TASK_COLS)
 if set(st.session_state.tasks_df.columns) != cols_check:
-    st.cache_data.clear()
-    st.session_state.tasks_df = ensure_date_columns(load_data())
+    fetch_data.clear()
+    st.session_state.tasks_df = load_data()
 
 if 'editing_task' not in st.session_state: st.session_state.editing_task = None
 if 'edit_index' not in st.session_state: st.session_state.edit_index = None
+if 'dirty' not in st.session_state: st.session_state.dirty = False
+if 'delete_marks' not in st.session_state: st.session_state.delete_marks = set()
 
-st.session_state.tasks_df = ensure_date_columns(st.session_state.tasks_df)
+# 未保存の編集は、最後の編集から3秒以上経った次の操作時にまとめて保存
+if st.session_state.dirty and time.monotonic() - st.session_state.last_edit > 3:
+    if save_data(st.session_state.tasks_df):
+        st.toast("変更を保存しました", icon="💾")
+    else:
+        # 失敗したら次の再試行まで再び3秒空け、操作のたびに保存を繰り返さない
+        st.session_state.last_edit = time.monotonic()
 
 # 通知ロジック
 today = datetime.date.today()
-df_base = st.session_state.tasks_df.copy()
+df_base = st.session_state.tasks_df
 
 try:
     if '進捗' in df_base.columns and '期限' in df_base.columns:
-        due_ts = pd.to_datetime(df_base['期限'], errors='coerce')
-        is_expired = due_ts < pd.Timestamp(today)
-        alert_rows = df_base[(df_base['進捗'] != '完了') & (is_expired | (df_base['優先度'] == '高'))]
-        alert_count = len(alert_rows)
+        alert_count = count_alerts(today)
     else:
         alert_count = 0
 except:
@@ -233,50 +384,52 @@ with col_a:
 with st.sidebar:
     st.header("📧 通知設定")
     
-    def_user = st.secrets["gmail"]["user_email"] if "gmail" in st.secrets else ""
-    def_pass = st.secrets["gmail"]["app_password"] if "gmail" in st.secrets else ""
-    def_name_val = st.secrets["gmail"]["user_name"] if "gmail" in st.secrets else "タスク管理Bot"
+    gmail_secrets = st.secrets.get("gmail", {})
+    def_user = gmail_secrets.get("user_email", "")
+    def_pass = gmail_secrets.get("app_password", "")
+    def_name_val = gmail_secrets.get("user_name", "タスク管理Bot")
 
     gmail_user = st.text_input("送信元Gmail", value=def_user, disabled=True, help="Secretsの設定値が使用されます")
     gmail_name = st.text_input("送信元名", value=def_name_val, placeholder="タスク管理Bot")
     gmail_pass = st.text_input("アプリパスワード", value=def_pass, type="password", disabled=True, help="Secretsの設定値が使用されます")
     
     st.markdown("---")
-    target_email = st.text_input("送信先メール", placeholder="boss@company.com")
+    target_email = st.text_input("送信先メール", placeholder="boss@company.com", help="カンマ区切りで複数指定できます")
+    target_emails = [e.strip() for e in target_email.split(",") if e.strip()]
     
     all_assignees = []
     if not st.session_state.tasks_df.empty:
-        ass_cols = [c for c in ['担当者1','担当者2','担当者3'] if c in st.session_state.tasks_df.columns]
+        ass_cols = [c for c in ASSIGNEE_COLS if c in st.session_state.tasks_df.columns]
         if ass_cols:
-            raw_ass = st.session_state.tasks_df[ass_cols].astype(str).values.ravel('K')
-            unique_ass = pd.unique(raw_ass)
-            all_assignees = [x for x in unique_ass if x and x.lower() != "nan" and x.lower() != "none"]
+            all_assignees = get_assignees(ass_cols)
     
-    target_name = st.selectbox("宛名 (担当者を選択)", options=[""] + sorted(all_assignees))
+    target_name = st.selectbox("宛名 (担当者を選択)", options=[""] + all_assignees)
     
     if st.button("📩 通知送信"):
-        if gmail_user and gmail_pass and target_email and target_name:
-            checked_rows = df_base[df_base['通知'] == True]
-            incomplete_rows = checked_rows[checked_rows['進捗'] != '完了']
-            
-            target_rows = incomplete_rows[
-                (incomplete_rows['担当者1'] == target_name) |
-                (incomplete_rows['担当者2'] == target_name) |
-                (incomplete_rows['担当者3'] == target_name)
-            ]
+        if gmail_user and gmail_pass and target_emails and target_name:
+            # 通知チェック・未完了・担当者一致を1つのマスクにまとめて1回で抽出する
+            mask = (
+                df_base['通知'].to_numpy(dtype=bool)
+                & (df_base['進捗'].to_numpy() != '完了')
+                & (df_base[ASSIGNEE_COLS].to_numpy() == target_name).any(axis=1)
+            )
+            target_rows = df_base[mask]
             
             email_count = len(target_rows)
             
             if email_count > 0:
-                body = f"{target_name} 様\n\nお疲れ様です。\n現在残っているタスクのお知らせです。\n\n"
-                for _, r in target_rows.iterrows():
-                    assignees = f"{r.get('担当者1','')} {r.get('担当者2','')} {r.get('担当者3','')}"
-                    body += f"・{r['タイトル']}\n  期限:{r['期限']} / 担当:{assignees}\n  優先度:{r['優先度']} / 進捗:{r['進捗']}\n\n"
-                
-                body += "-"*30 + "\n"
-                body += f"▼ アプリを開いて確認する\n{APP_URL}\n"
-
-                if send_gmail("【タスク通知】未完了案件一覧", body, target_email, target_name, gmail_user, gmail_name, gmail_pass):
+                header = f"{target_name} 様\n\nお疲れ様です。\n現在残っているタスクのお知らせです。\n\n"
+                mail_cols = ['タイトル', '期限', '担当者1', '担当者2', '担当者3', '優先度', '進捗']
+                # 欠損(期限なしなど)は空文字にしてから文字列化する (pandas 3ではastype(str)がNaNを残す)
+                t = target_rows[mail_cols].astype(object).fillna("").astype(str)
+                lines = (
+                    "・" + t['タイトル'] + "\n  期限:" + t['期限'] + " / 担当:" + t['担当者1'] + " " + t['担当者2'] + " " + t['担当者3']
+                    + "\n  優先度:" + t['優先度'] + " / 進捗:" + t['進捗'] + "\n"
+                )
+                footer = "-"*30 + "\n" + f"▼ アプリを開いて確認する\n{APP_URL}\n"
+                body = header + "\n".join(lines.tolist()) + "\n" + footer
+
+                if send_gmail("【タスク通知】未完了案件一覧", body, target_emails, target_name, gmail_user, gmail_name, gmail_pass):
                     st.success(f"{target_name}様のタスク {email_count}件を送信しました")
             else:
                 st.warning(f"「{target_name}」様のタスクで、通知チェック(✉️)が入った未完了タスクがありません。")
@@ -286,42 +439,46 @@ with st.sidebar:
 # --- タスク登録フォーム ---
 with st.expander(f"**タスク登録 / 編集**", expanded=True):
     task = st.session_state.editing_task if st.session_state.editing_task else {}
-    c1, c2 = st.columns(2)
+    # フォーム内の入力では再実行せず、送信時に1回だけ再実行する
+    with st.form("task_form", clear_on_submit=False):
+        c1, c2 = st.columns(2)
     
-    with c1:
-        title = st.text_input("①タイトル", value=task.get("タイトル", ""))
-        details = st.text_area("②詳細", value=task.get("詳細", ""), height=100)
-        last_req = st.session_state.tasks_df["依頼者"].iloc[-1] if not st.session_state.tasks_df.empty else ""
-        requester = st.text_input("③依頼者", value=task.get("依頼者", last_req))
+        with c1:
+            title = st.text_input("①タイトル", value=task.get("タイトル", ""))
+            details = st.text_area("②詳細", value=task.get("詳細", ""), height=100)
+            last_req = st.session_state.tasks_df["依頼者"].iloc[-1] if not st.session_state.tasks_df.empty else ""
+            requester = st.text_input("③依頼者", value=task.get("依頼者", last_req))
         
-        st.write("④担当者")
-        ac1, ac2, ac3 = st.columns(3)
-        as1 = ac1.text_input("担当1", task.get("担当者1",""), label_visibility="collapsed", placeholder="担当1")
-        as2 = ac2.text_input("担当2", task.get("担当者2",""), label_visibility="collapsed", placeholder="担当2")
-        as3 = ac3.text_input("担当3", task.get("担当者3",""), label_visibility="collapsed", placeholder="担当3")
-
-    with c2:
-        priority = st.selectbox("⑤優先度", PRIORITY_OPTIONS, index=PRIORITY_OPTIONS.index(task.get("優先度", "高")))
-        status = st.selectbox("⑥進捗", STATUS_OPTIONS, index=STATUS_OPTIONS.index(task.get("進捗", "未対応")))
+            st.write("④担当者")
+            ac1, ac2, ac3 = st.columns(3)
+            as1 = ac1.text_input("担当1", task.get("担当者1",""), label_visibility="collapsed", placeholder="担当1")
+            as2 = ac2.text_input("担当2", task.get("担当者2",""), label_visibility="collapsed", placeholder="担当2")
+            as3 = ac3.text_input("担当3", task.get("担当者3",""), label_visibility="collapsed", placeholder="担当3")
+
+        with c2:
+            priority = st.selectbox("⑤優先度", PRIORITY_OPTIONS, index=PRIORITY_OPTIONS.index(task.get("優先度", "高")))
+            status = st.selectbox("⑥進捗", STATUS_OPTIONS, index=STATUS_OPTIONS.index(task.get("進捗", "未対応")))
         
-        dc1, dc2 = st.columns(2)
-        def_due = task.get("期限") if isinstance(task.get("期限"), datetime.date) else datetime.date.today() + datetime.timedelta(days=7)
-        due_date = dc1.date_input("⑦期限", value=def_due)
+            dc1, dc2 = st.columns(2)
+            def_due = task.get("期限") if isinstance(task.get("期限"), datetime.date) else datetime.date.today() + datetime.timedelta(days=7)
+            due_date = dc1.date_input("⑦期限", value=def_due)
         
-        def_comp = task.get("完了日") if isinstance(task.get("完了日"), datetime.date) else (datetime.date.today() if status=="完了" else None)
-        completion_date = dc2.date_input("⑧完了日", value=def_comp)
+            def_comp = task.get("完了日") if isinstance(task.get("完了日"), datetime.date) else (datetime.date.today() if status=="完了" else None)
+            completion_date = dc2.date_input("⑧完了日", value=def_comp)
+
+            remarks = st.text_area("⑨備考", value=task.get("備考", ""))
 
-        remarks = st.text_area("⑨備考", value=task.get("備考", ""))
+        submitted = st.form_submit_button("登録・更新", type="primary")
 
-    if st.button("登録・更新", type="primary"):
+    if submitted:
         if not title:
             st.error("タイトルは必須です")
         else:
             new_data = {
-                "削除": False, "通知": False, "タイトル": title, "詳細": details, "依頼者": requester,
+                "通知": False, "タイトル": title, "詳細": details, "依頼者": requester,
                 "担当者1": as1, "担当者2": as2, "担当者3": as3, 
                 "優先度": priority, "進捗": status,
-                "期限": due_date, "完了日": completion_date if completion_date and status=="完了" else None, "備考": remarks
+                "期限": due_date, "完了日": (completion_date or datetime.date.today()) if status=="完了" else None, "備考": remarks
             }
             if st.session_state.edit_index is not None:
                 st.session_state.tasks_df.loc[st.session_state.edit_index] = new_data
@@ -329,10 +486,13 @@ with st.expander(f"**タスク登録 / 編集**", expanded=True):
                 st.session_state.edit_index = None
                 st.success("更新しました")
             else:
-                st.session_state.tasks_df = pd.concat([st.session_state.tasks_df, pd.DataFrame([new_data])], ignore_index=True)
+                # 1行分を既存の列の型(カテゴリ・Arrow文字列)に揃えてから連結し、型を保ったまま追加する
+                df = st.session_state.tasks_df
+                new_row = pd.DataFrame([new_data], columns=df.columns).astype(df.dtypes)
+                st.session_state.tasks_df = pd.concat([df, new_row], ignore_index=True)
                 st.success("登録しました")
             
-            st.session_state.tasks_df = ensure_date_columns(st.session_state.tasks_df)
+            bump_data_version()
             save_data(st.session_state.tasks_df)
             st.rerun()
             
@@ -350,66 +510,61 @@ with st.expander("🔎 フィルター"):
     f_ass = fc2.multiselect("担当者", all_assignees)
     f_key = fc3.text_input("検索")
 
-df_view = st.session_state.tasks_df.copy()
-if f_pri: df_view = df_view[df_view['優先度'].isin(f_pri)]
-if f_ass: df_view = df_view[df_view['担当者1'].isin(f_ass) | df_view['担当者2'].isin(f_ass) | df_view['担当者3'].isin(f_ass)]
-if f_key: df_view = df_view[df_view['タイトル'].str.contains(f_key, na=False)]
+df_all = st.session_state.tasks_df
+mask = np.ones(len(df_all), dtype=bool)
+if f_pri: mask &= df_all['優先度'].isin(f_pri).to_numpy()
+if f_ass: mask &= df_all[ASSIGNEE_COLS].isin(f_ass).to_numpy().any(axis=1)
+if f_key: mask &= df_all['タイトル'].str.contains(f_key, na=False, regex=False).to_numpy(dtype=bool)
+df_view = df_all[mask]
 
-df_active = df_view[df_view['進捗'] != '完了'].copy()
-df_completed = df_view[df_view['進捗'] == '完了'].copy()
+is_done = (df_view['進捗'] == '完了').to_numpy()
+df_active = df_view[~is_done]
+df_completed = df_view[is_done]
 
-col_cfg = {
-    "通知": st.column_config.CheckboxColumn(width="small", label="✉️", help="チェックしたタスクをメール通知します"),
-    "削除": st.column_config.CheckboxColumn(width="small", label="🗑️"),
-    "期限": st.column_config.DateColumn(format="YYYY-MM-DD"),
-    "完了日": st.column_config.DateColumn(format="YYYY-MM-DD"),
-    "優先度": st.column_config.SelectboxColumn(options=PRIORITY_OPTIONS),
-    "進捗": st.column_config.SelectboxColumn(options=STATUS_OPTIONS)
-}
+if st.session_state.dirty:
+    st.warning("未保存の変更があります")
+if st.button("💾 変更を保存", disabled=not st.session_state.dirty):
+    # 失敗時は再実行せず、保存エラーの表示を残す
+    if save_data(st.session_state.tasks_df): st.rerun()
 
 # A. 未完了タスク
 st.subheader("🔥 未完了タスク")
-df_active = ensure_date_columns(df_active)
-active_cols = ["通知", "削除", "タイトル", "詳細", "依頼者", "担当者1", "担当者2", "担当者3", "優先度", "進捗", "期限", "完了日", "備考"]
 
+# 削除チェック列は表示時にだけ付ける
+df_active_view = df_active.assign(削除=df_active.index.isin(list(st.session_state.delete_marks)))
 ed_act = st.data_editor(
-    df_active, 
-    column_config=col_cfg, 
-    column_order=active_cols, 
+    df_active_view, 
+    column_config=COL_CFG, 
+    column_order=ACTIVE_COLS, 
     hide_index=True, 
     key="act", 
     num_rows="dynamic"
 )
 
 if st.session_state.act.get("edited_rows"):
-    for idx, chg in st.session_state.act["edited_rows"].items():
-        real_idx = df_active.index[idx]
-        for c, v in chg.items(): st.session_state.tasks_df.at[real_idx, c] = v
-    st.session_state.tasks_df = ensure_date_columns(st.session_state.tasks_df)
-    save_data(st.session_state.tasks_df)
+    apply_edited_rows(st.session_state.act["edited_rows"], df_active)
     st.rerun()
 
 if st.button("🗑️ チェックした行を削除 (未完了)"):
     # 削除対象を取得
-    del_mask = st.session_state.tasks_df['削除']
+    del_mask = st.session_state.tasks_df.index.isin(list(st.session_state.delete_marks))
     del_rows = st.session_state.tasks_df[del_mask]
     
     if not del_rows.empty:
         # ★履歴シートへ保存
         if save_deleted_log(del_rows):
-            # メインから削除
+            # メインから削除 (シートは残りの行を1回の書き込みで詰め直す)
             idx = del_rows.index
             st.session_state.tasks_df.drop(idx, inplace=True)
             st.session_state.tasks_df.reset_index(drop=True, inplace=True)
             
             # 列の再構築（バグ防止）
-            if "削除" not in st.session_state.tasks_df.columns:
-                st.session_state.tasks_df.insert(1, "削除", False)
             if "通知" not in st.session_state.tasks_df.columns:
                 st.session_state.tasks_df.insert(0, "通知", False)
                 
-            st.session_state.tasks_df["削除"] = False
             st.session_state.tasks_df["通知"] = False
+            st.session_state.delete_marks = set()
+            bump_data_version()
 
             save_data(st.session_state.tasks_df)
             st.success(f"{len(del_rows)}件のタスクを削除し、履歴に保存しました。")
@@ -419,30 +574,24 @@ st.markdown("---")
 
 # B. 完了済みタスク
 st.subheader("✅ 完了済みタスク")
-df_completed = ensure_date_columns(df_completed)
-completed_cols = ["タイトル", "詳細", "依頼者", "担当者1", "担当者2", "担当者3", "優先度", "進捗", "期限", "完了日", "備考"]
 
 ed_comp = st.data_editor(
     df_completed, 
-    column_config=col_cfg, 
-    column_order=completed_cols, 
+    column_config=COL_CFG, 
+    column_order=COMPLETED_COLS, 
     hide_index=True, 
     key="comp"
 )
 
 if st.session_state.comp.get("edited_rows"):
-    for idx, chg in st.session_state.comp["edited_rows"].items():
-        real_idx = df_completed.index[idx]
-        for c, v in chg.items(): st.session_state.tasks_df.at[real_idx, c] = v
-    st.session_state.tasks_df = ensure_date_columns(st.session_state.tasks_df)
-    save_data(st.session_state.tasks_df)
+    apply_edited_rows(st.session_state.comp["edited_rows"], df_completed)
     st.rerun()
 
 # --- 削除履歴の表示エリア ---
 st.markdown("---")
 with st.expander("🗑️ 削除履歴 (過去に削除されたタスク)"):
     if st.button("履歴を更新"):
-        st.cache_data.clear()
+        load_deleted_log.clear()
         
     df_log = load_deleted_log()
     if not df_log.empty:
@@ -455,9 +604,7 @@ with st.sidebar:
     st.markdown("---")
     if st.button("🔧 接続テスト"):
         try:
-            client = get_gspread_client()
-            sheet = client.open(SHEET_NAME).sheet1
-            val = sheet.acell('A1').value
+            val = with_sheet(lambda sheet: sheet.acell('A1').value)
             st.success(f"✅ 接続成功！\nスプレッドシートが見つかりました。\nA1セルの値: {val}")
         except Exception as e:
             st.error(f"❌ 接続失敗\n原因: {e}")